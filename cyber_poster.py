@@ -1,85 +1,387 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import json
+import codecs
+import atexit
+import hashlib
 import random
+import sys
+import time
+import orjson
 import requests
-import feedparser
-from datetime import datetime
+from lxml import etree, html
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load secrets from environment (GitHub Actions)
 load_dotenv()
 
+def int_env(name, default=None):
+    """Read an integer setting, exiting on a malformed value like the checks below."""
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        sys.exit(f"Invalid config: {name} must be an integer, got {value!r}")
+
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
-THREAD_ID = os.getenv("MESSAGE_THREAD_ID")  # For the "News" topic
-RSS_FEEDS = os.getenv("RSS_FEEDS", "").split(",")
-POSTED_FILE = os.getenv("POSTED_FILE", "posted_urls.txt")
+THREAD_ID = int_env("MESSAGE_THREAD_ID")  # For the "News" topic
+RSS_FEEDS = [u.strip() for u in os.getenv("RSS_FEEDS", "").split(",") if u.strip()]
+POSTED_FILE = os.getenv("POSTED_FILE", "posted_urls.txt")  # Legacy single-file history
+POSTED_DIR = os.getenv("POSTED_DIR", "posted_urls")
+FEED_STATE_FILE = os.getenv("FEED_STATE_FILE", "feed_state.json")
+FEED_TTL = int_env("FEED_TTL", 900)  # Seconds before a feed is fetched again
+MAX_FEED_TTL = 12 * 3600  # Cap on a feed's own <ttl>, so a daily run never skips a feed
+MAX_RETRY_AFTER = 60  # Longest Telegram flood-wait worth sleeping through, in seconds
+
+# Fail fast on missing config instead of after a wasted fetch and a failed post
+if not (BOT_TOKEN and CHAT_ID and RSS_FEEDS):
+    sys.exit("Missing config: TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID and RSS_FEEDS must be set")
 
 BASE_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
-# Ensure posted_urls.txt exists
-if not os.path.exists(POSTED_FILE):
-    open(POSTED_FILE, "w").close()
+# Escape tables for Telegram's HTML parse mode
+_HTML_TRANS = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+_ATTR_TRANS = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
+# Feed XML namespaces; plain RSS 2.0 has none
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+RSS1_NS = "{http://purl.org/rss/1.0/}"
+
+# Summaries are re-encoded and parsed as UTF-8 bytes, since lxml refuses str
+# input that carries its own encoding declaration
+_HTML_PARSER = html.HTMLParser(encoding="utf-8")
+_NON_TEXT_TAGS = ("script", "style", "head")
+
+# Byte-order marks and XML declarations that name the body's own encoding
+_BOMS = (codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+_XML_ENCODING_DECL = re.compile(rb"\s*<\?xml[^>]*encoding=")
+_CHARSET_PARAM = re.compile(r"charset=[\"']?([\w.:-]+)", re.I)
 
-# Load previously posted URLs
-with open(POSTED_FILE, "r") as f:
-    posted_urls = set(line.strip() for line in f if line.strip())
+# Reuse one keep-alive connection pool for all HTTP calls
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# Previously posted URLs (as bytes) per shard, loaded only for shards that get checked
+posted_shards = {}
+
+# Append-only descriptors for the shards written this run
+_shard_fds = {}
+
+def _close_shards():
+    for fd in _shard_fds.values():
+        os.close(fd)
+
+atexit.register(_close_shards)
 
 def log(message):
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-    print(f"[{now}] {message}")
+    now = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime())
+    # One write per line so messages from fetch threads don't interleave
+    print(f"[{now}] {message}\n", end="")
 
-def fetch_news():
-    """Fetch all news from the RSS feeds and return only new (unposted) ones."""
-    new_items = []
-    for feed_url in RSS_FEEDS:
-        feed_url = feed_url.strip()
-        if not feed_url:
+def read_lines(f):
+    """Return the non-blank lines of a history file opened in binary mode."""
+    # Split on line breaks only (feed links can contain spaces), all in C
+    return set(f.read().replace(b"\r", b"").split(b"\n")) - {b""}
+
+def shard_of(line):
+    """Return the shard (first hex digit of its SHA-1) a URL is recorded in."""
+    return hashlib.sha1(line).hexdigest()[0]
+
+def shard_path(shard):
+    return os.path.join(POSTED_DIR, f"{shard}.txt")
+
+def init_posted_dir():
+    """Create the shard directory, splitting up a legacy POSTED_FILE once."""
+    if os.path.isdir(POSTED_DIR):
+        return
+    shards = {}
+    if os.path.exists(POSTED_FILE):
+        with open(POSTED_FILE, "rb") as f:
+            for line in read_lines(f):
+                shards.setdefault(shard_of(line), []).append(line)
+    # Build the shards aside and rename, so a crash can't leave half a history
+    tmp_dir = POSTED_DIR + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for shard, lines in shards.items():
+        with open(os.path.join(tmp_dir, f"{shard}.txt"), "wb") as f:
+            f.write(b"\n".join(lines) + b"\n")
+    os.rename(tmp_dir, POSTED_DIR)
+    if shards:
+        log(f"Migrated {sum(map(len, shards.values()))} posted URLs into {POSTED_DIR}/")
+
+def load_posted(shards):
+    """Load previously posted URLs from the given shard files."""
+    for shard in shards:
+        if shard in posted_shards:
             continue
-        parsed = feedparser.parse(feed_url)
-        log(f"Fetched {len(parsed.entries)} items from {feed_url}")
-        for entry in parsed.entries:
-            url = entry.get("link")
-            if not url or url in posted_urls:
-                continue  # Skip duplicates
-            title = entry.get("title", "No title")
-            summary = entry.get("summary", "")[:400]
-            new_items.append({"title": title, "url": url, "summary": summary})
-    return new_items
+        urls = set()
+        if os.path.exists(shard_path(shard)):
+            with open(shard_path(shard), "rb") as f:
+                urls.update(read_lines(f))
+        posted_shards[shard] = urls
+
+def load_feed_state():
+    """Load the cached validators and entries of each feed."""
+    if not os.path.exists(FEED_STATE_FILE):
+        return {}
+    try:
+        with open(FEED_STATE_FILE, "r") as f:
+            return json.load(f)
+    except ValueError:
+        log(f"⚠️ Ignoring unreadable {FEED_STATE_FILE}")
+        return {}
+
+def save_feed_state(state):
+    """Write the feed state atomically so a crash never leaves half a file."""
+    tmp_file = FEED_STATE_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, FEED_STATE_FILE)
+
+def _text(element):
+    return "".join(element.itertext()).strip() if element is not None else ""
+
+def html_to_text(markup):
+    """Reduce an HTML summary to plain text, so tags aren't posted or cut in half."""
+    if not markup.strip():
+        return ""
+    try:
+        fragment = html.fromstring(markup.encode(), parser=_HTML_PARSER)
+    except etree.ParserError:
+        return ""  # Markup with no content, e.g. only comments
+    # Stylesheets, scripts and document titles aren't part of the readable text
+    if fragment.tag in _NON_TEXT_TAGS:
+        return ""
+    etree.strip_elements(fragment, *_NON_TEXT_TAGS, with_tail=False)
+    return " ".join(" ".join(fragment.itertext()).split())
+
+def _atom_text(element):
+    """Text of an Atom text construct, reducing html/xhtml types to plain text."""
+    text = _text(element)
+    if element is not None and element.get("type") in ("html", "xhtml"):
+        return html_to_text(text)
+    return text
+
+def make_xml_parser(head, charset):
+    """Build a parser for a body starting with ``head``.
+
+    The HTTP charset is only used when the body has no BOM or encoding declaration.
+    The parser tolerates slightly broken feeds and never expands entities or hits the network.
+    """
+    if head.startswith(_BOMS) or _XML_ENCODING_DECL.match(head):
+        charset = None
+    try:
+        return etree.XMLParser(
+            recover=True, resolve_entities=False, no_network=True, encoding=charset
+        )
+    except LookupError:
+        # Unknown charset in the header: let lxml detect it
+        return etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+
+def parse_feed(chunks, base_url, charset=None):
+    """Pull link, title and summary out of each RSS 2.0, RSS 1.0 or Atom entry.
+
+    ``chunks`` is an iterable of body bytes, fed to the parser as they arrive.
+    Also returns the feed's own <ttl> in seconds (0 if absent or invalid).
+    """
+    parser = None
+    for chunk in chunks:
+        if parser is None:
+            parser = make_xml_parser(chunk, charset)
+        parser.feed(chunk)
+    if parser is None:
+        parser = make_xml_parser(b"", charset)
+    root = parser.close()
+    if root is None:
+        return [], 0
+    try:
+        ttl = min(int(_text(root.find("channel/ttl")) or 0) * 60, MAX_FEED_TTL)
+    except ValueError:
+        ttl = 0
+    entries = []
+    for item in root.iter("item", f"{RSS1_NS}item"):
+        ns = RSS1_NS if item.tag.startswith(RSS1_NS) else ""
+        link = _text(item.find(f"{ns}link"))
+        if not link:
+            # RSS 2.0 permalinks stand in for a missing <link>, as in feedparser
+            guid = item.find("guid")
+            if guid is not None and guid.get("isPermaLink", "true") != "false":
+                link = _text(guid)
+        if link:
+            entries.append({
+                "link": urljoin(base_url, link),
+                "title": _text(item.find(f"{ns}title")) or "No title",
+                "summary": html_to_text(_text(item.find(f"{ns}description")))[:400],
+            })
+    for entry in root.iter(f"{ATOM_NS}entry"):
+        link = next(
+            (el.get("href") for el in entry.iterfind(f"{ATOM_NS}link")
+             if el.get("href") and el.get("rel", "alternate") == "alternate"),
+            None,
+        )
+        summary = entry.find(f"{ATOM_NS}summary")
+        if summary is None:
+            summary = entry.find(f"{ATOM_NS}content")
+        if link:
+            entries.append({
+                "link": urljoin(base_url, link),
+                "title": _atom_text(entry.find(f"{ATOM_NS}title")) or "No title",
+                "summary": html_to_text(_text(summary))[:400],
+            })
+    return entries, ttl
+
+def fetch_feed(feed_url, cached):
+    """Fetch one feed with a conditional GET, reusing cached entries on 304."""
+    now = time.time()
+    # The feed's own <ttl> can only stretch the interval, never shorten it
+    if now - cached.get("fetched", 0) < max(FEED_TTL, cached.get("ttl", 0)):
+        log(f"Feed fetched recently, reusing {len(cached.get('entries', []))} items from {feed_url}")
+        return cached
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("modified"):
+        headers["If-Modified-Since"] = cached["modified"]
+    try:
+        with SESSION.get(feed_url, headers=headers, timeout=15, stream=True) as resp:
+            if resp.status_code == 304:
+                log(f"Feed unchanged, reusing {len(cached.get('entries', []))} items from {feed_url}")
+                return {**cached, "fetched": now}
+            resp.raise_for_status()
+            # Parse the (decompressed) body chunk by chunk instead of buffering it;
+            # only what a post needs is kept, so unchanged feeds can be served from the cache
+            charset = _CHARSET_PARAM.search(resp.headers.get("Content-Type", ""))
+            entries, ttl = parse_feed(
+                resp.iter_content(chunk_size=16384), resp.url, charset and charset.group(1)
+            )
+    except requests.RequestException as e:
+        log(f"⚠️ Failed to fetch {feed_url}: {e}")
+        return cached
+    except Exception as e:
+        # Any parse failure stays confined to this feed
+        log(f"⚠️ Failed to parse {feed_url}: {e}")
+        return cached
+    log(f"Fetched {len(entries)} items from {feed_url}")
+    return {
+        "etag": resp.headers.get("ETag"),
+        "modified": resp.headers.get("Last-Modified"),
+        "fetched": now,
+        "ttl": ttl,
+        "entries": entries,
+    }
+
+def fetch_news():
+    """Fetch all news from the RSS feeds and pick one new (unposted) item at random."""
+    state = load_feed_state()
+    cached = [state.get(u, {}) for u in RSS_FEEDS]
+
+    # Feeds are fetched concurrently; filtering below stays on this thread
+    with ThreadPoolExecutor(max_workers=min(8, len(RSS_FEEDS))) as executor:
+        results = list(executor.map(fetch_feed, RSS_FEEDS, cached))
+
+    # Feeds no longer configured drop out of the state here
+    save_feed_state(dict(zip(RSS_FEEDS, results)))
+
+    # Hash each feed's links once; the membership test below then runs per feed
+    feed_links = []
+    for feed in results:
+        links = []
+        for entry in feed.get("entries", []):
+            if entry.get("link"):
+                line = entry["link"].encode()
+                links.append((entry, line, shard_of(line)))
+        feed_links.append(links)
+
+    # Nothing to de-duplicate if every feed came back empty
+    if not any(feed_links):
+        return None
+    # Only the shards these URLs hash to are read from disk
+    load_posted({shard for links in feed_links for _, _, shard in links})
+
+    chosen = None
+    count = 0
+    for links in feed_links:
+        fresh = [entry for entry, line, shard in links if line not in posted_shards[shard]]
+        if not fresh:
+            continue  # Every entry of this feed was already posted
+        # Batched reservoir sampling: this feed takes the pick with probability len(fresh)/count
+        count += len(fresh)
+        if random.randrange(count) < len(fresh):
+            chosen = random.choice(fresh)
+
+    # Only the winning entry is turned into a post; parse_feed() already applied
+    # the title default and summary length
+    if chosen is None:
+        return None
+    return {"title": chosen["title"], "url": chosen["link"], "summary": chosen["summary"]}
 
 def send_telegram_message(title, summary, url):
     """Send a message to Telegram (either to general or a topic)."""
-    message = f"<b>{title}</b>\n\n{summary}\n\n<a href='{url}'>Read more</a>"
+    title_e = title.translate(_HTML_TRANS)
+    summary_e = summary.translate(_HTML_TRANS)
+    url_e = url.translate(_ATTR_TRANS)
+    message = f'<b>{title_e}</b>\n\n{summary_e}\n\n<a href="{url_e}">Read more</a>'
     payload = {
         "chat_id": CHAT_ID,
         "text": message,
         "parse_mode": "HTML",
         "disable_web_page_preview": False
     }
-    if THREAD_ID:
-        payload["message_thread_id"] = int(THREAD_ID)
-    res = requests.post(f"{BASE_API}/sendMessage", json=payload)
+    if THREAD_ID is not None:
+        payload["message_thread_id"] = THREAD_ID
+    body = orjson.dumps(payload)
+    headers = {"Content-Type": "application/json"}
+    res = SESSION.post(f"{BASE_API}/sendMessage", data=body, headers=headers, timeout=10)
+    # Retry once on rate limiting or a transient server error
+    if res.status_code == 429 or res.status_code >= 500:
+        retry_after = 2
+        if res.status_code == 429:
+            try:
+                retry_after = res.json()["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError):
+                pass
+        valid = isinstance(retry_after, (int, float)) and not isinstance(retry_after, bool)
+        if valid and 0 <= retry_after <= MAX_RETRY_AFTER:
+            log(f"⚠️ Telegram returned {res.status_code}, retrying in {retry_after}s")
+            time.sleep(retry_after)
+            res = SESSION.post(f"{BASE_API}/sendMessage", data=body, headers=headers, timeout=10)
+        else:
+            # A long flood-wait would stall the job; fail this post instead
+            log(f"⚠️ Telegram returned {res.status_code} with retry_after={retry_after!r}, not retrying")
     res.raise_for_status()
     return res.json()
 
 def save_posted(url):
-    """Add a posted URL to the record file."""
-    posted_urls.add(url)
-    with open(POSTED_FILE, "a") as f:
-        f.write(url + "\n")
+    """Add a posted URL to its shard file."""
+    line = url.encode()
+    shard = shard_of(line)
+    if shard in posted_shards:
+        posted_shards[shard].add(line)
+    fd = _shard_fds.get(shard)
+    if fd is None:
+        fd = _shard_fds[shard] = os.open(
+            shard_path(shard), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+    os.write(fd, line + b"\n")
 
 def main():
+    init_posted_dir()
     log("Fetching latest articles...")
-    news_items = fetch_news()
+    # Post only ONE article per run (and skip duplicates automatically)
+    item = fetch_news()
 
-    if not news_items:
+    if not item:
         log("⚠️ No new unique articles found today — skipping post.")
         return
 
-    # Post only ONE article per run (and skip duplicates automatically)
-    item = random.choice(news_items)
-
     try:
         send_telegram_message(item["title"], item["summary"], item["url"])
         save_posted(item["url"])